@@ -0,0 +1,212 @@
+#! /bin/env python3
+
+# SyLeX
+#   Build descriptor for LaTeX
+
+# Benchmarks of the expansion path
+#
+#   python3 bench.py [--lines N] [--markers P] [--depth D] [--includes P]
+#                    [--save FILE] [--compare FILE]
+#   python3 bench.py --startup [--budget MS]
+#
+# Each stage is timed on a synthetic document (best of --repeat runs) and
+# reported in MB/s and lines/s. --save stores the results as JSON, and
+# --compare fails if a stage got slower than a stored baseline by more
+# than --tolerance.
+#
+# --startup instead measures the imports done by `sylex expand`, and fails
+# if they take longer than --budget or if they include jinja2.
+# Timings assume that bytecode is cached (no PYTHONDONTWRITEBYTECODE).
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import subprocess
+from argparse import ArgumentParser
+
+import lib
+import log
+import expand
+
+features = ["student", "teacher", "solutions", "draft"]
+
+# A document of `lines` lines, where a proportion `markers` of the lines are
+# conditional markers nested at most `depth` deep, and a proportion
+# `includes` of the lines \input or \includegraphics a relative path.
+def synthetic(*, lines, markers=0.02, depth=2, includes=0.05, seed=0):
+    rng = random.Random(seed)
+    text = []
+    # for each open block, whether it already has an $(ELSE)
+    blocks = []
+    while len(text) < lines:
+        r = rng.random()
+        if r < markers:
+            k = rng.random()
+            if len(blocks) < depth and (len(blocks) == 0 or k < 0.4):
+                text.append(f"% $(IF({rng.choice(features)}))")
+                blocks.append(False)
+            elif k < 0.6 and not blocks[-1]:
+                text.append(f"% $(ELIF(NOT({rng.choice(features)})))")
+            elif k < 0.8 and not blocks[-1]:
+                text.append("% $(ELSE)")
+                blocks[-1] = True
+            else:
+                text.append("% $(ENDIF)")
+                blocks.pop()
+        elif r < markers + includes:
+            text.append(rng.choice([
+                r"\input{$(HERE)/section/part}",
+                r"\include{$(PREV)/chapter/intro}",
+                r"\includegraphics[width=\linewidth]{$(PREV2)/figures/plot}",
+                r"\input{$(ROOT)/common/macros}",
+            ]))
+        else:
+            text.append(rng.choice([
+                r"Some text that does not need to be rewritten at all, only scanned.",
+                r"An equation $x^2 + y^2 = z^2$ and a reference~\ref{fig:plot}.",
+                r"% A comment",
+                r"",
+            ]))
+    text.extend("% $(ENDIF)" for _ in blocks)
+    return "\n".join(text) + "\n"
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class Suite:
+    def __init__(self, text, repeat):
+        self.text = text
+        self.size = len(text.encode())
+        self.lines = text.count("\n") + 1
+        self.repeat = repeat
+        self.results = {}
+
+    def run(self, label, fn):
+        seconds = timed(fn, self.repeat)
+        self.results[label] = {
+            'seconds': seconds,
+            'mb_s': self.size / seconds / 1e6,
+            'lines_s': self.lines / seconds,
+        }
+        r = self.results[label]
+        print(f"{label:<16} {seconds*1000:9.2f} ms  {r['mb_s']:8.2f} MB/s  {r['lines_s']/1e6:6.2f} Mlines/s")
+
+
+def bench(text, repeat):
+    suite = Suite(text, repeat)
+    feats = expand.Features(["teacher"])
+    with tempfile.TemporaryDirectory() as tmp:
+        i = f"{tmp}/chapter__section__file.src.tex"
+        o = f"{tmp}/build/chapter__section__file.tex"
+        os.makedirs(f"{tmp}/build")
+        with open(i, 'w') as f:
+            f.write(text)
+        # Stages
+        resolved = expand.filepaths(text, o)
+        suite.run("filepaths", lambda: expand.filepaths(text, o))
+        suite.run("trim", lambda: feats.trim(resolved))
+        # End to end
+        for engine in ['read', 'stream', 'mmap']:
+            suite.run(f"expand[{engine}]", lambda: expand.expand(i=i, o=o, features=feats, engine=engine))
+        variants = [(f"{tmp}/build/v{k}.tex", expand.Features([f])) for (k, f) in enumerate(features)]
+        suite.run(f"variants[{len(variants)}]", lambda: expand.expand_variants(i=i, variants=variants, cache=False))
+    return suite
+
+
+# Stages whose throughput dropped by more than `tolerance` compared to `baseline`
+def regressions(results, baseline, tolerance):
+    slower = []
+    for (label, r) in results.items():
+        if label not in baseline:
+            continue
+        ratio = r['mb_s'] / baseline[label]['mb_s']
+        print(f"{label:<16} {ratio*100:6.1f}% of baseline")
+        if ratio < 1 - tolerance:
+            slower.append(label)
+    return slower
+
+
+# Total import time (in ms) of `python3 <args>` and the modules it imported,
+# as reported by `python3 -X importtime`
+def import_time(args):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", *args],
+        capture_output=True,
+        text=True,
+    )
+    total = 0
+    modules = []
+    for line in proc.stderr.split("\n"):
+        if not line.startswith("import time:"):
+            continue
+        (us, _, name) = line[len("import time:"):].split("|")
+        if us.strip().isdigit():
+            total += int(us)
+            modules.append(name.strip())
+    return (total / 1000, modules)
+
+# Import time of `sylex expand` on top of the interpreter's own startup,
+# best of `repeat` runs since timings of a single run are very noisy
+def startup(budget, repeat):
+    sylex = [f"{lib.slx_dir or '.'}/sylex.py", "expand", "--help"]
+    (ms, modules) = min(import_time(sylex) for _ in range(repeat))
+    (bare, _) = min(import_time(["-c", "pass"]) for _ in range(repeat))
+    print(f"sylex expand: {ms - bare:.2f} ms of imports ({len(modules)} modules) "
+        f"over the interpreter's {bare:.2f} ms, budget {budget:.2f} ms")
+    ok = True
+    if "jinja2" in modules:
+        print("jinja2 should not be imported by `sylex expand`")
+        ok = False
+    if ms - bare > budget:
+        print("Import time over budget")
+        ok = False
+    return ok
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description='benchmark the expansion path')
+    parser.add_argument('--lines', type=int, default=200000, help='size of the synthetic document')
+    parser.add_argument('--markers', type=float, default=0.02, help='proportion of conditional markers')
+    parser.add_argument('--depth', type=int, default=2, help='maximum nesting of $(IF(...)) blocks')
+    parser.add_argument('--includes', type=float, default=0.05, help='proportion of \\input and the like')
+    parser.add_argument('--repeat', type=int, default=5, help='keep the best of this many runs')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results stored in this JSON file')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='acceptable slowdown (0.1 = 10%%)')
+    parser.add_argument('--startup', action='store_true', help='check the startup time of `sylex expand`')
+    parser.add_argument('--budget', type=float, default=40, help='(with --startup) maximum import time in ms')
+    res = parser.parse_args()
+    if res.startup:
+        sys.exit(0 if startup(res.budget, res.repeat) else 1)
+    log.Trace.verbose = 'n'
+    text = synthetic(lines=res.lines, markers=res.markers, depth=res.depth, includes=res.includes)
+    suite = bench(text, res.repeat)
+    if res.save is not None:
+        with open(res.save, 'w') as f:
+            json.dump({
+                'params': {
+                    'lines': res.lines,
+                    'markers': res.markers,
+                    'depth': res.depth,
+                    'includes': res.includes,
+                },
+                'results': suite.results,
+            }, f, indent=2)
+    if res.compare is not None:
+        with open(res.compare, 'r') as f:
+            baseline = json.load(f)
+        slower = regressions(suite.results, baseline['results'], res.tolerance)
+        if len(slower) > 0:
+            print(f"Regression in {', '.join(slower)}")
+            sys.exit(1)
@@ -0,0 +1,334 @@
+# SyLeX
+#   Build descriptor for LaTeX
+
+import os
+import re
+import shutil
+import hashlib
+import subprocess
+
+from error import Err
+from graph import Graph
+import lib
+import log
+
+# Native build of the documents, without going through make.
+#
+# The configurations are parsed once, then every document is built as
+# a graph of steps (expand its sources, compile its figures, compile it)
+# that is run by a pool of workers. Independent documents and figures are
+# compiled concurrently; each step is skipped if its targets are newer
+# than its sources, as make would.
+
+TEXFLAGS = ["--halt-on-error", "--interaction=nonstopmode"]
+
+# Figures are compiled in `build/.fig/<name>/` (relative to the build
+# directory, as for common.tex.mk), so that concurrent compilations do
+# not share their auxiliary files
+fig_dir = ".fig"
+
+# Same filter as the `compile` target of common.tex.mk
+re_noise = re.compile(r"texmf-dist|\.code\.tex|\.dict|^[^(]*\)")
+
+def filtered(out):
+    return "".join(
+        line + "\n" for line in out.split("\n")
+        if line.strip() != "" and not re_noise.search(line)
+    )
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+# A command run by a worker. Returns (success, output)
+def command(argv, cwd=None, filter=filtered):
+    def run():
+        try:
+            proc = subprocess.run(
+                argv,
+                cwd=cwd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                errors='replace',
+            )
+        except FileNotFoundError:
+            return (False, f"{argv[0]}: command not found\n")
+        return (proc.returncode == 0, filter(proc.stdout))
+    return run
+
+# Files written by pdflatex that are read back by the next pass
+rerun_exts = ["aux", "toc", "lof", "lot", "out", "nav", "snm", "bbl", "idx", "glo"]
+
+re_aux_input = re.compile(r"^\\@input\{(.*)\}", re.MULTILINE)
+re_bib = re.compile(r"^\\(citation|bibdata|bibstyle)\{(.*)\}", re.MULTILINE)
+
+def read(path):
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+# `name.aux` and the .aux of the files it \include's
+def aux_files(cwd, name):
+    main = f"{cwd}/{name}.aux"
+    text = (read(main) or b"").decode(errors='replace')
+    return [main] + [f"{cwd}/{a}" for a in re_aux_input.findall(text)]
+
+# Digests of everything the next pass of pdflatex depends on
+def snapshot(cwd, name):
+    paths = aux_files(cwd, name) + [f"{cwd}/{name}.{ext}" for ext in rerun_exts if ext != "aux"]
+    return { p: hashlib.sha256(read(p) or b"").hexdigest() for p in paths }
+
+# Digest of what bibtex reads: the \citation, \bibdata and \bibstyle
+# entries of the .aux files, and the databases they name.
+# None if the document has no bibliography.
+def bib_key(cwd, name):
+    entries = []
+    for aux in aux_files(cwd, name):
+        entries += re_bib.findall((read(aux) or b"").decode(errors='replace'))
+    if not any(kind == "bibdata" for (kind, _) in entries):
+        return None
+    h = hashlib.sha256()
+    for (kind, arg) in entries:
+        h.update(f"{kind}:{arg}\n".encode())
+        if kind == "bibdata":
+            for db in arg.split(","):
+                h.update(read(f"{cwd}/{db.strip()}.bib") or b"")
+    return h.hexdigest()
+
+# Compile `name.tex` (in `cwd`) until the files it reads back stop changing,
+# with at most `passes` runs of pdflatex. bibtex is run only when the
+# citations or the bibliography changed since it last ran, which is
+# recorded in `name.bibkey`. Returns (success, output), as a command.
+def converge(name, *, cwd=lib.build_dir, passes=5):
+    def run():
+        pdflatex = command(["pdflatex", *TEXFLAGS, f"{name}.tex"], cwd=cwd)
+        bibtex = command(["bibtex", name], cwd=cwd, filter=str)
+        out = []
+        state = snapshot(cwd, name)
+        for n in range(1, passes + 1):
+            (ok, text) = pdflatex()
+            out.append(text)
+            if not ok:
+                return (False, "".join(out))
+            key = bib_key(cwd, name)
+            if key is not None and (read(f"{cwd}/{name}.bibkey") or b"").decode() != key:
+                (ok, text) = bibtex()
+                out.append(text)
+                if not ok:
+                    return (False, "".join(out))
+                with open(f"{cwd}/{name}.bibkey", 'w') as f:
+                    f.write(key)
+            new = snapshot(cwd, name)
+            if new == state:
+                out.append(f"{name}: stable after {n} pass(es)\n")
+                return (True, "".join(out))
+            state = new
+        if passes > 1:
+            out.append(f"{name}: still changing after {passes} passes\n")
+        return (True, "".join(out))
+    return run
+
+def mkdir(path):
+    def run():
+        os.makedirs(path, exist_ok=True)
+        return (True, "")
+    return run
+
+def copy(src, dest):
+    def run():
+        try:
+            shutil.copy(src, dest)
+        except OSError as e:
+            return (False, f"{e}\n")
+        return (True, "")
+    return run
+
+
+# One node of the build graph.
+# - `cmds` are run in order by a worker thread, until one of them fails
+# - `inline` is instead run by the scheduler itself, for steps that are
+#   Python code: it returns whether it succeeded
+# The step is up to date if all of its `targets` exist and are newer
+# than all of its `sources`. A step without targets always runs.
+class Step:
+    PENDING = 'pending'
+    DONE = 'done'
+    FRESH = 'up to date'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, name, *, deps=[], targets=[], sources=[], cmds=[], inline=None):
+        self.name = name
+        self.deps = list(deps)
+        self.targets = targets
+        self.sources = sources
+        self.cmds = cmds
+        self.inline = inline
+        self.state = Step.PENDING
+
+    def fresh(self):
+        if len(self.targets) == 0:
+            return False
+        oldest = None
+        for t in self.targets:
+            m = mtime(t)
+            if m is None:
+                return False
+            oldest = m if oldest is None else min(oldest, m)
+        return all((mtime(s) or 0) <= oldest for s in self.sources)
+
+    def run(self):
+        out = []
+        for cmd in self.cmds:
+            (ok, text) = cmd()
+            out.append(text)
+            if not ok:
+                return (False, "".join(out))
+        return (True, "".join(out))
+
+    def __str__(self):
+        return self.name
+    def __repr__(self):
+        return self.__str__()
+
+
+# Run all `steps` with at most `jobs` commands at the same time.
+# All output is printed by the calling thread, one step at a time.
+# Returns whether all steps succeeded.
+def schedule(steps, jobs=1):
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    finished = (Step.DONE, Step.FRESH)
+    waiting = list(steps)
+    running = {}
+
+    def report(step, out=""):
+        log.info("{GRN}{0}{WHT}: {1}", step.name, step.state)
+        if out != "":
+            print(out, end="")
+
+    with ThreadPoolExecutor(max(jobs, 1)) as pool:
+        while len(waiting) > 0 or len(running) > 0:
+            progress = False
+            for step in list(waiting):
+                if any(d.state in (Step.FAILED, Step.SKIPPED) for d in step.deps):
+                    step.state = Step.SKIPPED
+                elif not all(d.state in finished for d in step.deps):
+                    continue
+                elif step.fresh():
+                    step.state = Step.FRESH
+                elif step.inline is not None:
+                    step.state = Step.DONE if step.inline() else Step.FAILED
+                else:
+                    running[pool.submit(step.run)] = step
+                    waiting.remove(step)
+                    continue
+                waiting.remove(step)
+                report(step)
+                progress = True
+            if progress:
+                continue
+            if len(running) == 0:
+                # only possible if the steps form a cycle
+                for step in waiting:
+                    step.state = Step.SKIPPED
+                    report(step)
+                break
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                (ok, out) = future.result()
+                step.state = Step.DONE if ok else Step.FAILED
+                report(step, out)
+    return all(step.state in finished for step in steps)
+
+
+# Steps that build `proj` from its parsed configuration `cfg`.
+# `figs` is shared by all projects, so that a figure used by several
+# documents is compiled only once.
+def steps_of(proj, cfg, *, features, quick, figs, jobs=1, passes=5):
+    import expand
+    into_build = lambda f: f.with_prefix(f"{lib.build_dir}").name_of_path()
+    into_pdf_build = lambda f: f.with_prefix(f"{lib.build_dir}").try_pdf().name_of_path()
+
+    def expand_sources():
+        fatality = Err.fatality
+        Err.fatality = Err.ALWAYS
+        expand.batch(proj.dest_manifest, features=features, jobs=jobs)
+        ok = Err.fatality < Err.ERROR
+        Err.fatality = max(fatality, Err.fatality)
+        return ok
+    sources = Step(f"expand {proj.name}", inline=expand_sources)
+    steps = [sources]
+
+    # A figure is also recompiled after the headers it depends on
+    graph = Graph.of_refs(cfg.refs)
+    graph.reduce(report=False)
+    for fig in cfg.fig:
+        pdf = into_pdf_build(fig)
+        if pdf not in figs:
+            tex = os.path.basename(into_build(fig))
+            name = tex[:-len(".tex")] if tex.endswith(".tex") else tex
+            out = f"{fig_dir}/{name}"
+            figs[pdf] = Step(
+                f"figure {fig.path()}",
+                targets=[pdf],
+                sources=[into_build(fig)],
+                cmds=[
+                    mkdir(f"{lib.build_dir}/{out}"),
+                    command(["pdflatex", *TEXFLAGS, "-output-directory", out, tex], cwd=lib.build_dir),
+                    copy(f"{lib.build_dir}/{out}/{name}.pdf", pdf),
+                ],
+            )
+            steps.append(figs[pdf])
+        figs[pdf].deps.append(sources)
+        figs[pdf].sources += [
+            into_build(graph.files[f]) for f in graph.closure(graph.file_index[fig])
+        ]
+
+    cmds = [
+        converge(proj.name, passes=1 if quick else passes),
+        copy(f"{lib.build_dir}/{proj.name}.pdf", f"{proj.name}.pdf"),
+    ]
+    steps.append(Step(
+        f"document {proj.name}",
+        deps=[sources] + [figs[into_pdf_build(fig)] for fig in cfg.fig],
+        targets=[f"{proj.name}.pdf"],
+        sources=[
+            *(into_pdf_build(fig) for fig in cfg.fig),
+            *(into_build(f) for f in cfg.txt + cfg.bib + cfg.hdr),
+            proj.src,
+            "sylex.conf",
+        ],
+        cmds=cmds,
+    ))
+    return steps
+
+
+# Parse the configurations of `projs`, refresh their generated files,
+# and build them. Returns whether everything succeeded.
+@log.path('Build documents')
+def build(projs, *, level, jobs=1, quick=False, passes=5):
+    import expand
+    import parse
+    conf = lib.read_conf()
+    cfgs = parse.parse_all(projs, level, jobs)
+    os.makedirs(lib.build_dir, exist_ok=True)
+    steps = []
+    figs = {}
+    ok = True
+    for (proj, (cfg, fatality)) in zip(projs, cfgs):
+        if cfg is None:
+            if level <= fatality:
+                ok = False
+            continue
+        Err.in_file(proj.src)
+        cfg.print(proj)
+        features = expand.Features(conf.get(f"FEATURES_{proj.name}", "").split())
+        steps += steps_of(proj, cfg, features=features, quick=quick, figs=figs, jobs=jobs, passes=passes)
+    return schedule(steps, jobs) and ok
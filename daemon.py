@@ -0,0 +1,183 @@
+# SyLeX
+#   Build descriptor for LaTeX
+
+import io
+import os
+import sys
+import json
+import socket
+import contextlib
+
+from error import Err
+import lib
+import log
+
+# Long-running server for the commands that make runs many times.
+#
+# Every invocation of sylex.py pays for the start of the interpreter, the
+# imports, and rebuilding its caches (parsed configurations, compiled
+# templates, directory listings). `sylex daemon` keeps all of these in
+# memory and listens on a Unix socket; `sylex expand` and `sylex build-conf`
+# forward their arguments to it when it is running, and otherwise run
+# as usual. The client is `sylex.forward`, which runs before any other
+# import.
+#
+# Requests are handled one at a time, each from the working directory of
+# its client. The protocol is a single JSON object in each direction:
+#   client: { "cwd", "argv", "slx_dir" }   or   { "stop": true }
+#   server: { "status", "out" }
+# with `status` None if the request was refused. A daemon started from
+# another copy of sylex refuses, and one whose source changed exits.
+
+# The socket and the commands are also spelled out in `sylex.forward`,
+# which cannot import this module
+socket_path = f"{lib.build_dir}/sylex.sock"
+
+# Commands that may be forwarded
+commands = ["expand", "build-conf"]
+
+def recv_all(conn):
+    chunks = []
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        chunks.append(data)
+    return json.loads(b"".join(chunks).decode())
+
+def send(conn, msg):
+    conn.sendall(json.dumps(msg).encode())
+    conn.shutdown(socket.SHUT_WR)
+
+
+# Client side: ask the daemon to exit. Forwarding is `sylex.forward`.
+def stop(path=socket_path):
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(path)
+            send(conn, { 'stop': True })
+            recv_all(conn)
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+# Server side
+class Daemon:
+    cwd = None
+    slx_dir = None
+    stamps = None
+
+    # Modification times of our own source, to notice `sylex init`
+    def sources():
+        stamps = {}
+        for mod in lib.py_files:
+            try:
+                stamps[mod] = os.stat(f"{Daemon.slx_dir}/{mod}.py").st_mtime_ns
+            except FileNotFoundError:
+                stamps[mod] = None
+        return stamps
+
+    # Bring the warm state up to date with the filesystem before a request
+    # from `cwd`. Listings and generated headers depend on the directory and
+    # the time; parsed configurations and compiled templates are keyed and
+    # checked by the modules that cache them.
+    def prepare(cwd):
+        os.chdir(cwd)
+        if cwd != Daemon.cwd:
+            lib.DirIndex.clear()
+            Daemon.cwd = cwd
+        else:
+            lib.DirIndex.refresh()
+        lib.now = __import__('datetime').datetime.now()
+        lib.autogen_header = lib.header(lib.now)
+        Err.fatality = Err.ALWAYS
+        Err.in_file("")
+
+    # Run `argv` through `run` (the command line parser of sylex),
+    # as a separate process would. Returns (status, output).
+    def execute(run, argv):
+        buf = io.StringIO()
+        status = 0
+        indent = log.Logger.indent
+        log.Logger.indent = 0
+        with contextlib.redirect_stdout(buf), contextlib.redirect_stderr(buf):
+            try:
+                run(argv)
+            except SystemExit as e:
+                if e.code is None:
+                    status = 0
+                elif isinstance(e.code, int):
+                    status = e.code
+                else:
+                    print(e.code)
+                    status = 1
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                status = 1
+        log.Logger.indent = indent
+        return (status, buf.getvalue())
+
+    def handle(run, req):
+        if req.get('slx_dir') != Daemon.slx_dir:
+            # a different copy of sylex: let the client run its own
+            return { 'status': None, 'out': "" }
+        if len(req.get('argv', [])) == 0 or req['argv'][0] not in commands:
+            return { 'status': None, 'out': "" }
+        Daemon.prepare(req['cwd'])
+        (status, out) = Daemon.execute(run, req['argv'])
+        return { 'status': status, 'out': out }
+
+
+@log.path('Serve requests on {BLU}{0}{WHT}')
+def serve(path, run):
+    path = os.path.abspath(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        if stop(path):
+            log.info("replaced the daemon that was running")
+        else:
+            log.info("removed the socket of a daemon that exited")
+        if os.path.exists(path):
+            os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    inode = os.stat(path).st_ino
+    home = os.getcwd()
+    Daemon.slx_dir = os.path.abspath(lib.slx_dir)
+    Daemon.stamps = Daemon.sources()
+    try:
+        while True:
+            (conn, _) = server.accept()
+            with conn:
+                try:
+                    req = recv_all(conn)
+                except (OSError, ValueError):
+                    continue
+                if req.get('stop'):
+                    # the socket is released before the reply, so that
+                    # whoever asked can bind it right away
+                    os.unlink(path)
+                    send(conn, { 'status': 0, 'out': "" })
+                    break
+                if Daemon.sources() != Daemon.stamps:
+                    # our code was replaced, and what is loaded is outdated
+                    log.info("source of sylex changed, exiting")
+                    os.unlink(path)
+                    send(conn, { 'status': None, 'out': "" })
+                    break
+                reply = Daemon.handle(run, req)
+                try:
+                    send(conn, reply)
+                except OSError:
+                    pass
+                os.chdir(home)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.chdir(home)
+        if os.path.exists(path) and os.stat(path).st_ino == inode:
+            os.unlink(path)
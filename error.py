@@ -7,6 +7,7 @@
 class Err:
     fname = ""
     line = 0
+    text = ""
 
     ALWAYS = 0
     WARNING = 1
@@ -17,6 +18,7 @@ class Err:
     def in_file(fname):
         Err.fname = fname
         Err.line = 0
+        Err.text = ""
 
     def count_line(text):
         Err.line += 1
@@ -1,81 +1,106 @@
 from error import Err
+import os
 import re
+import hashlib
+import mmap
+import shutil
+import functools
+import lib
 import log
 
-re_replace = re.compile(r"\$\(.*\)/")
-re_here = re.compile(r"\$\(HERE\)/")
-re_root = re.compile(r"\$\(ROOT\)/")
-re_prev = re.compile(r"\$\(PREV([0-9]*)\)/")
+re_placeholder = re.compile(r"\$\((HERE|ROOT|PREV([0-9]*))\)/")
 re_slash = re.compile(r"\\(input|includegraphics|include)")
 
-@log.path('Resolve file paths')
-def filepaths(text, name):
-    # Replace $(HERE) with the actual path
+def paths_of(name):
+    # Directories of `name` from the innermost outwards, e.g.
+    # build/a__b__c.tex -> ["a__b__", "a__", ""]
     file_root = name.replace("build/", "")
     split = file_root.split("__")
     path = []
-    def get(lst, idx):
-        if idx < len(lst):
-            return lst[idx]
-        else:
-            return None
     while len(split) > 0:
         split.pop()
         path.append("__".join(split) + "__" if len(split) > 0 else "")
-    here = get(path, 0) or ""
-    prev = get(path, 1) or ""
-    root = ""
-    # Expand relative paths
-    lines = text.split("\n")
-    text = []
-    for line in lines:
-        if re_replace.search(line) is not None:
-            line = re.sub(re_here, here, line)
-            line = re.sub(re_root, root, line)
-            while True:
-                g = re_prev.search(line)
-                print(line, g)
-                if g is not None:
-                    i = int(g.group(1) or 1)
-                    print(f"0:'{g.group(0)}' 1:'{g.group(1)}' i:'{i}'")
-                    print(line.find(g.group(0)))
-                    line = line.replace(g.group(0), get(path, i) or "")
-                    print(line)
-                else:
-                    break
-        text.append(line)
-
-    text = "\n".join(text)
-    # Replace "/" with "__"
-    # This is an overapproximation, since it will replace
-    # all "/" in the same line as a input|includegraphics|include
-    # If this causes problems I'll implement a finer criteria
-    lines = text.split("\n")
-    text = []
-    for line in lines:
-        search = re_slash.search(line)
-        if search:
+    return path
+
+def get(lst, idx):
+    if idx < len(lst):
+        return lst[idx]
+    else:
+        return None
+
+
+# Path resolution for one output name:
+#   $(HERE)/ -> directory of the output
+#   $(PREV)/ -> its parent, $(PREV<n>)/ -> its n-th ancestor
+#   $(ROOT)/ -> the root
+# then "/" is replaced with "__" on lines that \input|\include|\includegraphics.
+# This is an overapproximation, since it will replace
+# all "/" in the same line as a input|includegraphics|include
+# If this causes problems I'll implement a finer criteria
+class Rewriter:
+    def __init__(self, name):
+        self.path = paths_of(name)
+        self.table = {
+            "HERE": get(self.path, 0) or "",
+            "ROOT": "",
+            "PREV": get(self.path, 1) or "",
+        }
+        for i in range(len(self.path)):
+            self.table[f"PREV{i}"] = self.path[i]
+
+    def substitute(self, m):
+        s = self.table.get(m.group(1))
+        if s is None:
+            s = get(self.path, int(m.group(2))) or ""
+        return s
+
+    def rewrite(self, line):
+        if "$(" in line:
+            line = re_placeholder.sub(self.substitute, line)
+        if "\\in" in line and re_slash.search(line):
             line = line.replace("/", "__")
-        text.append(line)
-    return "\n".join(text)
+        return line
 
+@functools.lru_cache(maxsize=256)
+def rewriter(name):
+    return Rewriter(name)
+
+def resolve_paths(lines, name):
+    rewrite = rewriter(name).rewrite
+    for line in lines:
+        yield rewrite(line)
+
+@log.path('Resolve file paths')
+def filepaths(text, name):
+    return "\n".join(resolve_paths(text.split("\n"), name))
+
+# State of one $(IF(...)) block for several variants at once:
+# bit v of each mask is the state of the block for variant v.
+# With a single variant (full == 1) masks are just 0 or 1.
 class Cond:
-    def __init__(self, val):
+    def __init__(self, val, full=1):
+        self.full = full
         self.true = val
         self.has_else = False
         self.was_true = val
 
     def do_elif(self, val):
-        if not self.was_true:
-            self.true = val
-            self.was_true = val
+        # only for the variants where no branch was taken yet
+        sel = self.full & ~self.was_true
+        self.true = (self.true & ~sel) | (val & sel)
+        self.was_true = (self.was_true & ~sel) | (val & sel)
 
     def do_else(self):
-        self.do_elif(True)
+        self.do_elif(self.full)
         self.has_else = True
 
     def __str__(self):
-        return ":True:" if self.true else ":False:"
+        if self.full == 1:
+            return ":True:" if self.true else ":False:"
+        return ":" + "".join(
+            "T" if (self.true >> v) & 1 else "F"
+            for v in range(self.full.bit_length())
+        ) + ":"
     def __repr__(self):
         return self.__str__()
 
@@ -83,12 +108,16 @@ class Cond:
 re_feature = re.compile(r"^[a-z]+$")
 re_cond = re.compile(r"^(\s|%)*\$\((.*)\)\s*")
 
-def parse_assert(cond, msg):
-    if not cond:
-        Err.report(
-            kind="Parsing error",
-            msg=msg,
-        )
+# Number of arguments of each construct, 0 for the features
+arity = {
+    'IF': 1,
+    'ELIF': 1,
+    'NOT': 1,
+    'TRUE': 0,
+    'FALSE': 0,
+    'ENDIF': 0,
+    'ELSE': 0,
+}
 
 
 class Args:
@@ -97,11 +126,6 @@ class Args:
     def push(self, arg):
         self.list.append(arg)
 
-    def check_len(self, length, construct):
-        parse_assert(
-            len(self.list) == length,
-            f"Argument to {construct} should be of length {length}",
-        )
     def __str__(self):
         return ",".join(a.__str__() for a in self.list)
 
@@ -114,38 +138,6 @@ class Cmd:
         self.fn = fn
         self.args = args or Args()
 
-    def validate(self):
-        arity = {
-            'IF': 1,
-            'ELIF': 1,
-            'NOT': 1,
-            'TRUE': 0,
-            'FALSE': 0,
-            'ENDIF': 0,
-            'ELSE': 0,
-        }.get(self.fn) or 0
-        self.args.check_len(arity, self.fn)
-
-    def evaluate(self, features):
-        self.validate()
-        match self.fn:
-            case ("IF"|"ELIF"):
-                return self.args.list[0].evaluate(features)
-            case "NOT":
-                return not self.args.list[0].evaluate(features)
-            case "TRUE":
-                return True
-            case "FALSE":
-                return False
-            case other:
-                if other == other.lower():
-                    return features.query(other)
-                else:
-                    Err.report(
-                        kind="Unable to evaluate",
-                        msg=f"'{cmd.fn}' is not a known construct",
-                    )
-
     def push(self, arg):
         if arg is not None:
             self.args.push(arg)
@@ -204,6 +196,66 @@ def structure(string):
     return parse()
 
 
+# A condition compiled into a closure over the features.
+# Diagnostics are found once when compiling, and reported again
+# every time the condition is evaluated.
+class Compiled:
+    def __init__(self, cmd):
+        self.cmd = cmd or Cmd('')
+        self.fn = self.cmd.fn
+        self.errors = []
+        self.test = self.compile(self.cmd)
+
+    def error(self, kind, msg):
+        self.errors.append((kind, msg))
+
+    def compile(self, cmd):
+        length = arity.get(cmd.fn) or 0
+        args = cmd.args.list
+        if len(args) != length:
+            self.error("Parsing error", f"Argument to {cmd.fn} should be of length {length}")
+        match cmd.fn:
+            case ("IF"|"ELIF"):
+                if len(args) == 0:
+                    return lambda features: False
+                return self.compile(args[0])
+            case "NOT":
+                if len(args) == 0:
+                    return lambda features: True
+                inner = self.compile(args[0])
+                return lambda features: not inner(features)
+            case "TRUE":
+                return lambda features: True
+            case "FALSE":
+                return lambda features: False
+            case other:
+                if other == other.lower():
+                    return lambda features: features.query(other)
+                else:
+                    self.error("Unable to evaluate", f"'{other}' is not a known construct")
+                    return lambda features: None
+
+    # Evaluate for all variants at once, diagnostics are reported only once
+    def mask(self, variants):
+        for (kind, msg) in self.errors:
+            Err.report(kind=kind, msg=msg)
+        m = 0
+        for (v, features) in enumerate(variants):
+            if self.test(features):
+                m |= 1 << v
+        return m
+
+    def __str__(self):
+        return self.cmd.__str__()
+    def __repr__(self):
+        return self.__str__()
+
+# Conditions are shared by all files expanded in the same process
+@functools.lru_cache(maxsize=1024)
+def compile_cond(string):
+    return Compiled(structure(string))
+
+
 class Features:
     def __init__(self, lst):
         self.all = set(lst)
@@ -218,81 +270,170 @@ class Features:
 
     @log.path('Trim conditional compilation')
     def trim(self, text):
-        transformed = []
-        cond_stack = []
-        include = True
-        for line in text.split("\n"):
+        return '\n'.join(self.trim_lines(text.split("\n")))
+
+    def trim_lines(self, lines):
+        trimmer = Trimmer([self])
+        for line in lines:
             Err.count_line(line)
-            search = re_cond.search(line)
-            if search:
-                cmd = structure(search.group(2))
-                match cmd.fn:
-                    case "IF":
-                        res = cmd.evaluate(self)
-                        cond_stack.append(Cond(res))
-                        log.Logger.indent_inc()
-                        log.info("{0} -> {YLW}{1}{WHT}", cmd, cond_stack[-1])
-                    case  "ELIF":
-                        res = cmd.evaluate(self)
-                        if len(cond_stack) > 0:
-                            if cond_stack[-1].has_else:
-                                Err.report(
-                                    kind="Duplicate else clause",
-                                    msg="corresponding $(IF(...)) already has an $(ELSE), this $(ELIF(...)) is unreachable",
-                                )
-                            cond_stack[-1].do_elif(res)
-                            log.info("{0} -> {YLW}{1}{WHT}", cmd, cond_stack[-1])
-                        else:
-                            Err.report(
-                                kind="Not in a conditional block",
-                                msg="$(ELIF(...)) provided without matching $(IF(...)) conditional",
-                            )
-
-                    case "ENDIF":
-                        if len(cond_stack) > 0:
-                            cond_stack.pop()
-                            log.info("{0}", cmd)
-                            log.Logger.indent_dec()
-                        else:
-                            Err.report(
-                                kind="Not in a conditional block",
-                                msg="$(ENDIF) provided without matching $(IF(...)) conditional",
-                            )
-                    case "ELSE":
-                        if len(cond_stack) > 0:
-                            if cond_stack[-1].has_else:
-                                Err.report(
-                                    kind="Duplicate else clause",
-                                    msg="corresponding $(IF(...)) already has an $(ELSE), this $(ELSE) is unreachable",
-                                )
-                            cond_stack[-1].do_else()
-                            log.info("{0} -> {YLW}{1}{WHT}", cmd, cond_stack[-1])
-                        else:
-                            Err.report(
-                                kind="Not in a conditional block",
-                                msg="$(ELSE) provided without matching $(IF(...)) conditional",
-                            )
-                    case other:
+            if not trimmer.marker(line) and trimmer.include:
+                yield line
+        trimmer.finish()
+
+
+# Conditional compilation of several variants at once.
+# `include` is the mask of the variants that keep the current line.
+class Trimmer:
+    def __init__(self, variants):
+        self.variants = variants
+        self.full = (1 << len(variants)) - 1
+        self.cond_stack = []
+        self.include = self.full
+
+    # Process `line` if it is a conditional marker, and tell whether it was one
+    def marker(self, line):
+        if "$(" not in line:
+            return False
+        search = re_cond.search(line)
+        if not search:
+            return False
+        cond_stack = self.cond_stack
+        cmd = compile_cond(search.group(2))
+        match cmd.fn:
+            case "IF":
+                res = cmd.mask(self.variants)
+                cond_stack.append(Cond(res, self.full))
+                log.Logger.indent_inc()
+                log.info("{0} -> {YLW}{1}{WHT}", cmd, cond_stack[-1])
+            case  "ELIF":
+                res = cmd.mask(self.variants)
+                if len(cond_stack) > 0:
+                    if cond_stack[-1].has_else:
+                        Err.report(
+                            kind="Duplicate else clause",
+                            msg="corresponding $(IF(...)) already has an $(ELSE), this $(ELIF(...)) is unreachable",
+                        )
+                    cond_stack[-1].do_elif(res)
+                    log.info("{0} -> {YLW}{1}{WHT}", cmd, cond_stack[-1])
+                else:
+                    Err.report(
+                        kind="Not in a conditional block",
+                        msg="$(ELIF(...)) provided without matching $(IF(...)) conditional",
+                    )
+
+            case "ENDIF":
+                if len(cond_stack) > 0:
+                    cond_stack.pop()
+                    log.info("{0}", cmd)
+                    log.Logger.indent_dec()
+                else:
+                    Err.report(
+                        kind="Not in a conditional block",
+                        msg="$(ENDIF) provided without matching $(IF(...)) conditional",
+                    )
+            case "ELSE":
+                if len(cond_stack) > 0:
+                    if cond_stack[-1].has_else:
                         Err.report(
-                            kind="Parsing error of conditional marker",
-                            msg=f"'{other}' is not a keyword",
+                            kind="Duplicate else clause",
+                            msg="corresponding $(IF(...)) already has an $(ELSE), this $(ELSE) is unreachable",
                         )
-                include = all(c.true for c in cond_stack)
-                #print(cmd)
-                #print(f"depth:{cond_stack}, include:{include}")
-            elif include:
-                transformed.append(line)
-        if len(cond_stack) > 0:
+                    cond_stack[-1].do_else()
+                    log.info("{0} -> {YLW}{1}{WHT}", cmd, cond_stack[-1])
+                else:
+                    Err.report(
+                        kind="Not in a conditional block",
+                        msg="$(ELSE) provided without matching $(IF(...)) conditional",
+                    )
+            case other:
+                Err.report(
+                    kind="Parsing error of conditional marker",
+                    msg=f"'{other}' is not a keyword",
+                )
+        include = self.full
+        for c in cond_stack:
+            include &= c.true
+        self.include = include
+        return True
+
+    def finish(self):
+        if len(self.cond_stack) > 0:
             Err.report(
                 kind="Unterminated conditional",
-                msg=f"file ended with {len(cond_stack)} $(IF(...)) still open, consider adding $(ENDIF) where appropriate",
+                msg=f"file ended with {len(self.cond_stack)} $(IF(...)) still open, consider adding $(ENDIF) where appropriate",
             )
-        return '\n'.join(transformed)
 
 
+# Resolve the conditional blocks of `lines` once for all `variants`.
+# The result is a table of (mask, lines) segments, where the lines
+# of a segment belong to the output of variant v iff bit v of mask is set.
+# As in `expand`, markers are recognized once paths are resolved
+# (e.g. "$(HERE)/..." is not one), hence `rewrite`.
+def segments(lines, variants, rewrite=lambda line: line):
+    trimmer = Trimmer(variants)
+    table = []
+    for line in lines:
+        resolved = rewrite(line)
+        Err.count_line(resolved)
+        if trimmer.marker(resolved) or trimmer.include == 0:
+            continue
+        if len(table) == 0 or table[-1][0] != trimmer.include:
+            table.append((trimmer.include, []))
+        table[-1][1].append(line)
+    trimmer.finish()
+    return table
+
+
+# Lines of `f` exactly as `f.read().split("\n")` would give them,
+# without ever holding more than one line in memory
+def read_lines(f):
+    line = ''
+    for line in f:
+        if line.endswith("\n"):
+            yield line[:-1]
+        else:
+            yield line
+            return
+    if line == '' or line.endswith("\n"):
+        yield ''
 
+def write_lines(f, lines):
+    first = True
+    for line in lines:
+        if not first:
+            f.write("\n")
+        f.write(line)
+        first = False
+
+
+# Whether there is anything to expand in the file at all: without any "$("
+# nor "\in" (as in \input, \include or \includegraphics) no line is rewritten
+# and no line is trimmed, so the file can be copied as is.
+# A "\r" counts as a marker too: expanding turns "\r\n" and "\r" into "\n",
+# and the output must not depend on whether the file has other markers.
+def has_markers(path):
+    with open(path, 'rb') as f:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m.find(b"$(") != -1 or m.find(b"\\in") != -1 or m.find(b"\r") != -1
+        except ValueError:
+            # empty file
+            return False
+
+# Returns 'verbatim' when the file was copied as is, 'expanded' otherwise
 @log.path('Expand {BLU}{i}{WHT}\nto {BLU}{o}{WHT}\nwith features {PPL}{features}{WHT}')
-def expand(*, i, o, features):
+def expand(*, i, o, features, engine='read'):
+    if i.endswith('tex') and not has_markers(i):
+        log.info("no markers, copied verbatim")
+        if i != o:
+            shutil.copyfile(i, o)
+        return 'verbatim'
+    if engine == 'stream':
+        expand_stream(i=i, o=o, features=features)
+        return 'expanded'
+    if engine == 'mmap':
+        expand_mmap(i=i, o=o, features=features)
+        return 'expanded'
     Err.in_file(i)
     with open(i, 'r') as f:
         text = f.read()
@@ -301,5 +442,272 @@ def expand(*, i, o, features):
         text = features.trim(text)
     with open(o, 'w') as f:
         f.write(text)
+    return 'expanded'
 
+# Same as `expand`, but the file goes through the pipeline one line at a time.
+# The output is written to a temporary file next to `o` so that `i` and `o`
+# may be the same file.
+def expand_stream(*, i, o, features):
+    Err.in_file(i)
+    tmp = f"{o}.tmp"
+    with open(i, 'r') as fi, open(tmp, 'w') as fo:
+        lines = read_lines(fi)
+        if i.endswith('tex'):
+            lines = resolve_paths(lines, o)
+            lines = features.trim_lines(lines)
+        write_lines(fo, lines)
+    os.replace(tmp, o)
+
+# Same as `expand`, over a memory map of the input: only the lines that
+# contain a marker are decoded and go through the pipeline, every byte
+# range in between is copied to the output (or dropped) as is.
+# The output is the same as `"\n".join(kept_lines)` would be.
+# Sources with a "\r" go through `expand_stream` instead, whose text mode
+# turns "\r\n" and "\r" into "\n" as the other engines do.
+def expand_mmap(*, i, o, features):
+    with open(i, 'rb') as fi:
+        with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            crlf = m.find(b"\r") != -1
+    if crlf:
+        expand_stream(i=i, o=o, features=features)
+        return
+    Err.in_file(i)
+    rewrite = rewriter(o).rewrite
+    trimmer = Trimmer([features])
+    tmp = f"{o}.tmp"
+    with open(i, 'rb') as fi, open(tmp, 'wb') as fo:
+        with mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            size = len(m)
+            # whether a "\n" is due before the next kept line
+            sep = False
+            pos = 0
+            dollar = m.find(b"$(")
+            incl = m.find(b"\\in")
+            while pos < size:
+                if dollar != -1 and dollar < pos:
+                    dollar = m.find(b"$(", pos)
+                if incl != -1 and incl < pos:
+                    incl = m.find(b"\\in", pos)
+                found = [k for k in (dollar, incl) if k != -1]
+                if len(found) == 0:
+                    start = end = size
+                else:
+                    start = m.rfind(b"\n", pos, min(found)) + 1 or pos
+                    end = m.find(b"\n", start)
+                    if end == -1:
+                        end = size
+                # Plain lines, up to and including the "\n" before `start`
+                if start > pos:
+                    chunk = m[pos:start]
+                    Err.line += chunk.count(b"\n") + (0 if chunk.endswith(b"\n") else 1)
+                    Err.text = chunk.removesuffix(b"\n").rsplit(b"\n", 1)[-1].decode(errors='replace')
+                    if trimmer.include:
+                        if sep:
+                            fo.write(b"\n")
+                        if chunk.endswith(b"\n"):
+                            fo.write(chunk[:-1])
+                        else:
+                            fo.write(chunk)
+                        sep = True
+                if start == size:
+                    break
+                # The line with a marker
+                line = rewrite(m[start:end].decode())
+                Err.count_line(line)
+                if not trimmer.marker(line) and trimmer.include:
+                    if sep:
+                        fo.write(b"\n")
+                    fo.write(line.encode())
+                    sep = True
+                pos = end + 1
+            # An empty last line if the file ends with "\n"
+            if size == 0 or m[size - 1] == ord("\n"):
+                Err.count_line('')
+                if trimmer.include and sep:
+                    fo.write(b"\n")
+            trimmer.finish()
+    os.replace(tmp, o)
+
+# Fingerprint of an expansion: everything that determines the contents of `o`.
+# The last fingerprint of each output is kept in `build/.cache/`, along with
+# the timestamp and size the output had once written, so that an output
+# that was modified or deleted since is never considered up to date.
+class Fingerprint:
+    dir = f"{lib.build_dir}/.cache"
+
+    def __init__(self, *, i, o, features):
+        h = hashlib.sha256()
+        with open(i, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                h.update(chunk)
+        h.update("\0".join([o, ",".join(sorted(features.all)), lib.date_modified]).encode())
+        self.key = h.hexdigest()
+        self.o = o
+        self.path = f"{Fingerprint.dir}/{o.replace('/', '__')}"
+
+    def stat(self):
+        st = os.stat(self.o)
+        return f"{self.key} {st.st_mtime_ns} {st.st_size}"
+
+    def fresh(self):
+        try:
+            with open(self.path, 'r') as f:
+                return f.read() == self.stat()
+        except FileNotFoundError:
+            return False
+
+    def store(self):
+        os.makedirs(Fingerprint.dir, exist_ok=True)
+        with open(f"{self.path}.tmp", 'w') as f:
+            f.write(self.stat())
+        os.replace(f"{self.path}.tmp", self.path)
+
+# Expand (or copy if it is not a .tex) `i` into `o`, unless `o` already
+# holds the result of the exact same expansion.
+# Returns what was done: 'expanded', 'verbatim' (a .tex without markers),
+# 'copied' (not a .tex) or 'cached'.
+def expand_file(*, i, o, features, engine='read', cache=True):
+    fingerprint = None
+    if cache and i != o:
+        fingerprint = Fingerprint(i=i, o=o, features=features)
+        if fingerprint.fresh():
+            log.info("{BLU}{0}{WHT} is up to date", o)
+            return 'cached'
+    if i.endswith("tex"):
+        done = expand(i=i, o=o, features=features, engine=engine)
+    else:
+        lib.copy_file(i, o)
+        done = 'copied'
+    if fingerprint is not None:
+        fingerprint.store()
+    return done
+
+# Give `o` a new timestamp, for the make rules that require it to be newer
+# than the outputs it depends on. Its fingerprint stays valid only if it
+# was before.
+def touch(*, i, o, features, cache=True):
+    if not os.path.exists(o):
+        return
+    fingerprint = None
+    if cache and i != o:
+        fingerprint = Fingerprint(i=i, o=o, features=features)
+        if not fingerprint.fresh():
+            fingerprint = None
+    os.utime(o)
+    if fingerprint is not None:
+        fingerprint.store()
+    log.info("{BLU}{0}{WHT} timestamp refreshed", o)
+
+
+# Expand `i` once into several outputs, given as a list of (o, features).
+# The source is read and its conditionals resolved only once, then each
+# variant is emitted by filtering the segments that it keeps.
+# Returns how many outputs were written.
+@log.path('Expand {BLU}{i}{WHT}\ninto several variants')
+def expand_variants(*, i, variants, cache=True):
+    pending = []
+    for (o, features) in variants:
+        fingerprint = None
+        if cache and i != o:
+            fingerprint = Fingerprint(i=i, o=o, features=features)
+            if fingerprint.fresh():
+                log.info("{BLU}{0}{WHT} is up to date", o)
+                continue
+        pending.append((o, features, fingerprint))
+    if len(pending) == 0:
+        return 0
+    if not i.endswith("tex") or not has_markers(i):
+        for (o, _, _) in pending:
+            lib.copy_file(i, o)
+    else:
+        Err.in_file(i)
+        with open(i, 'r') as f:
+            table = segments(
+                read_lines(f),
+                [features for (_, features, _) in pending],
+                rewrite=rewriter(pending[0][0]).rewrite,
+            )
+        for (v, (o, features, _)) in enumerate(pending):
+            log.info("{BLU}{0}{WHT} with features {PPL}{1}{WHT}", o, features)
+            rewrite = rewriter(o).rewrite
+            with open(f"{o}.tmp", 'w') as f:
+                write_lines(f, (
+                    rewrite(line)
+                    for (mask, lines) in table if (mask >> v) & 1
+                    for line in lines
+                ))
+            os.replace(f"{o}.tmp", o)
+    for (_, _, fingerprint) in pending:
+        if fingerprint is not None:
+            fingerprint.store()
+    return len(pending)
+
+
+# One line of a manifest written by `sylex build-conf`:
+#   src dest [post...]
+# where `dest` must also be refreshed whenever one of the `post` is.
+class Entry:
+    def __init__(self, line):
+        self.src, self.dest, *self.posts = line.split()
+
+    def __str__(self):
+        return f"{self.src} -> {self.dest}"
+    def __repr__(self):
+        return self.__str__()
 
+def read_manifest(path):
+    with open(path, 'r') as f:
+        return [Entry(line) for line in f if line.strip() != ""]
+
+# Select the entries that need to be expanded again, as a list of
+# (entry, touch) where `touch` tells that the output must end up newer
+# than its prerequisites, whether or not its own expansion was up to date:
+# it has one of its `post` among the selected entries.
+# - `only`: exactly these destinations (make asks for them because
+#   they are older than one of their `post`)
+# - `changed`: the sources that were modified (typically make's `$?`);
+#   anything that is not a known source (sylex.conf, the manifest itself)
+#   invalidates every entry. Missing destinations are always refreshed,
+#   and so are the entries that depend on a refreshed one through `posts`.
+# - neither: everything
+def outdated(entries, *, changed=None, only=None):
+    if only is not None:
+        only = set(only)
+        return [(e, True) for e in entries if e.dest in only]
+    if changed is None:
+        return [(e, len(e.posts) > 0) for e in entries]
+    srcs = set(e.src for e in entries)
+    if any(c not in srcs for c in changed):
+        return [(e, len(e.posts) > 0) for e in entries]
+    changed = set(changed)
+    todo = [e.dest for e in entries if e.src in changed or not os.path.exists(e.dest)]
+    induced = {}
+    for e in entries:
+        for p in e.posts:
+            induced.setdefault(p, []).append(e.dest)
+    seen = set(todo)
+    while len(todo) > 0:
+        for dest in induced.get(todo.pop(), []):
+            if dest not in seen:
+                seen.add(dest)
+                todo.append(dest)
+    return [(e, any(p in seen for p in e.posts)) for e in entries if e.dest in seen]
+
+# Entries are expanded in the order of the manifest, prerequisites first.
+# The workers may finish them in any order, so the outputs that must be
+# newer than others are touched afterwards, in that same order.
+@log.path('Expand files listed in {BLU}{0}{WHT}')
+def batch(manifest, *, features, changed=None, only=None, engine='read', jobs=1, cache=True):
+    entries = outdated(read_manifest(manifest), changed=changed, only=only)
+    done = lib.parallel(expand_file, [{
+        'i': e.src,
+        'o': e.dest,
+        'features': features,
+        'engine': engine,
+        'cache': cache,
+    } for (e, _) in entries], jobs)
+    for (e, refresh) in entries:
+        if refresh:
+            touch(i=e.src, o=e.dest, features=features, cache=cache)
+    log.info("{0} file(s) expanded, {1} without markers copied verbatim, {2} other file(s) copied, {3} up to date",
+        done.count('expanded'), done.count('verbatim'), done.count('copied'), done.count('cached'))
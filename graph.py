@@ -0,0 +1,181 @@
+# SyLeX
+#   Build descriptor for LaTeX
+
+from error import Err
+
+# Dependency graph of a project
+#
+# Nodes are of two kinds: the files of the project, and the labels
+# they declare with `>label` (the file depends on the label, stored in
+# `Refs.induce`) and `<label` (the file provides the label, typically a
+# header, stored in `Refs.depend`). Each kind has its own table mapping
+# nodes to consecutive indices, and edges are stored as lists of indices:
+#   induce[f] = labels that file f depends on
+#   depend[l] = files that provide label l
+# Edges of the file graph go from a file to its prerequisites, as in
+# the `file: prerequisites` rules that are generated from it.
+class Graph:
+    def __init__(self):
+        self.files = []
+        self.file_index = {}
+        self.labels = []
+        self.label_index = {}
+        self.induce = []
+        self.depend = []
+
+    def file(self, f):
+        i = self.file_index.get(f)
+        if i is None:
+            i = len(self.files)
+            self.file_index[f] = i
+            self.files.append(f)
+            self.induce.append([])
+        return i
+
+    def label(self, l):
+        i = self.label_index.get(l)
+        if i is None:
+            i = len(self.labels)
+            self.label_index[l] = i
+            self.labels.append(l)
+            self.depend.append([])
+        return i
+
+    # Graph of a `{ File: parse.Refs }` dictionary, files in the same order.
+    # Labels are sorted so that the output does not depend on set order.
+    def of_refs(refs):
+        g = Graph()
+        for (file, rs) in refs.items():
+            f = g.file(file)
+            for d in sorted(rs.depend):
+                g.depend[g.label(d)].append(f)
+        for (file, rs) in refs.items():
+            g.induce[g.file_index[file]] = [g.label(i) for i in sorted(rs.induce)]
+        return g
+
+    # Files that provide a label that file `f` depends on, each only once
+    def prerequisites(self, f):
+        seen = set()
+        out = []
+        for l in self.induce[f]:
+            for d in self.depend[l]:
+                if d not in seen:
+                    seen.add(d)
+                    out.append(d)
+        return out
+
+    # Strongly connected components of the file graph `adj` (Tarjan),
+    # numbered in reverse topological order: if there is an edge from a
+    # file in component i to a file in component j != i then i > j.
+    # Iterative, since a chain of headers can be deeper than the recursion limit.
+    def components(adj):
+        n = len(adj)
+        index = [None] * n
+        low = [0] * n
+        comp = [None] * n
+        comps = []
+        stack = []
+        count = 0
+        for root in range(n):
+            if index[root] is not None:
+                continue
+            work = [(root, 0)]
+            while len(work) > 0:
+                (v, k) = work.pop()
+                if k == 0:
+                    index[v] = low[v] = count
+                    count += 1
+                    stack.append(v)
+                if k < len(adj[v]):
+                    work.append((v, k + 1))
+                    w = adj[v][k]
+                    if index[w] is None:
+                        work.append((w, 0))
+                    elif comp[w] is None:
+                        low[v] = min(low[v], index[w])
+                    continue
+                if low[v] == index[v]:
+                    members = []
+                    while True:
+                        w = stack.pop()
+                        comp[w] = len(comps)
+                        members.append(w)
+                        if w == v:
+                            break
+                    comps.append(sorted(members))
+                if len(work) > 0:
+                    u = work[-1][0]
+                    low[u] = min(low[u], low[v])
+        return (comp, comps)
+
+    # Transitive closure and transitive reduction of the file graph.
+    #
+    # Files that depend on each other in a cycle are reported and then
+    # treated as a single node. On the resulting DAG, `reach[c]` is the set
+    # (as a bitmask) of components reachable from component `c`, and
+    # `keep[c]` the successors of `c` that are not reachable through another
+    # successor: these are enough for make to rebuild everything that is needed.
+    # Cycles are reported unless `report` is False, for callers that run
+    # after the configuration was already written (and checked).
+    def reduce(self, report=True):
+        adj = [self.prerequisites(f) for f in range(len(self.files))]
+        (comp, comps) = Graph.components(adj)
+        for members in comps:
+            if report and (len(members) > 1 or members[0] in adj[members[0]]):
+                Err.report(
+                    kind="Circular Dependency",
+                    msg="{} depend on each other".format(
+                        ", ".join(f"'{self.files[f]}'" for f in members)
+                    ),
+                    fatal=False,
+                )
+        reach = []
+        keep = []
+        # Components are numbered sinks first, so all successors of
+        # `c` are done by the time `c` is.
+        for (c, members) in enumerate(comps):
+            succ = sorted(
+                set(comp[d] for f in members for d in adj[f] if comp[d] != c),
+                reverse=True,
+            )
+            # In topological order, a successor can only be reached through
+            # one that comes before it
+            covered = 0
+            kept = set()
+            for s in succ:
+                if not covered >> s & 1:
+                    kept.add(s)
+                    covered |= reach[s] | 1 << s
+            reach.append(covered)
+            keep.append(kept)
+        self.adj = adj
+        self.comp = comp
+        self.comps = comps
+        self.reach = reach
+        self.keep = keep
+
+    # Transitive prerequisites of file `f`: all the files that `f` has to
+    # be refreshed after, excluding `f` itself
+    def closure(self, f):
+        c = self.comp[f]
+        r = self.reach[c]
+        return [
+            d for d in range(len(self.files))
+            if (r >> self.comp[d] & 1) or (self.comp[d] == c and d != f)
+        ]
+
+    # `(file, prerequisites)` for all files that have prerequisites,
+    # keeping only the edges of the transitive reduction
+    def edges(self):
+        self.reduce()
+        for f in range(len(self.files)):
+            c = self.comp[f]
+            out = []
+            seen = set()
+            for d in self.adj[f] + [d for g in self.comps[c] for d in self.adj[g]]:
+                b = self.comp[d]
+                if b in self.keep[c] and b not in seen:
+                    seen.add(b)
+                    out.extend(self.comps[b])
+            if len(out) > 0:
+                yield (self.files[f], [self.files[d] for d in out])
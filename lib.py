@@ -1,11 +1,19 @@
 # SyLeX
 #   Build descriptor for LaTeX
 
+import io
 import os
+import sys
 import shutil
-import jinja2 as j2
+import hashlib
+import functools
+import contextlib
+from error import Err
 import log
 
+# jinja2 and concurrent.futures are only imported by the functions that need
+# them: `sylex expand` is run once per file and should start as fast as possible
+
 slx_dir = "/".join(d for d in __file__.split("/")[:-1] if d != ".")
 templ_dir = f"{slx_dir}/templates"
 
@@ -13,14 +21,16 @@ local_slx_dir = ".sylex"
 local_templ_dir = f"{local_slx_dir}/templates"
 build_dir = "build"
 
-py_files = ["error", "expand", "lib", "log", "parse", "sylex"]
+py_files = ["build", "daemon", "error", "expand", "graph", "lib", "log", "parse", "sylex", "watch"]
 j2_mk_files = ["common", "pdf", "param", "deps"]
 j2_files = ["Makefile", "texwatch"] + [f + ".tex.mk" for f in j2_mk_files]
 
 date_modified = "2022-01-07"
 py_version = 10
-now = __import__('datetime').datetime.now()
-autogen_header = f"""\
+
+# Header of the generated files, dated `now`
+def header(now):
+    return f"""\
 # This file is autogenerated.
 # It should not be edited manually, as it will be overwritten
 # by `sylex init` without confirmation
@@ -35,6 +45,9 @@ autogen_header = f"""\
 # File generated: {now}
 """
 
+now = __import__('datetime').datetime.now()
+autogen_header = header(now)
+
 def is_filename(s):
     for c in s:
         if not (
@@ -45,10 +58,24 @@ def is_filename(s):
             return False
     return True
 
+# Environment shared by all renderings of the process in project `cwd`, so
+# that each template is compiled at most once. Compiled templates are also
+# kept across runs in the build directory, if there is one yet.
+@functools.lru_cache(maxsize=None)
+def j2_env(cwd):
+    import jinja2 as j2
+    cache = None
+    if os.path.isdir(f"{cwd}/{build_dir}"):
+        os.makedirs(f"{cwd}/{build_dir}/.j2cache", exist_ok=True)
+        cache = j2.FileSystemBytecodeCache(f"{cwd}/{build_dir}/.j2cache")
+    return j2.Environment(
+        loader=j2.FileSystemLoader([templ_dir, f"{cwd}/{local_templ_dir}"]),
+        bytecode_cache=cache,
+    )
+
 @log.path('Render {BLU}{0}.j2{WHT} to {BLU}{1}{WHT}')
 def j2_render(src, dest, *, tabs=True, params={}):
-    with open(f"{templ_dir}/{src}.j2", 'r') as f:
-        template = j2.Template(f.read())
+    template = j2_env(os.getcwd()).get_template(f"{src}.j2")
     text = template.render(
         header=autogen_header,
         build=build_dir,
@@ -58,8 +85,50 @@ def j2_render(src, dest, *, tabs=True, params={}):
         text = '\n'.join(
             line.replace(" "*4, "\t") if not line.startswith('#')
             else line for line in text.split('\n'))
-    with open(dest, 'w') as f:
+    return write_if_changed(dest, text)
+
+# Digest of a generated file, not counting the date in `autogen_header`
+def digest(text):
+    text = '\n'.join(
+        line for line in text.split('\n')
+        if not line.startswith("# File generated:"))
+    return hashlib.sha256(text.encode()).hexdigest()
+
+# Generated files are prerequisites of the documents: a file that would be
+# rewritten with the same contents is left alone so that its timestamp does
+# not trigger a rebuild. Otherwise it is replaced atomically.
+# Returns whether `dest` was written.
+def write_if_changed(dest, text):
+    try:
+        with open(dest, 'r') as f:
+            if digest(f.read()) == digest(text):
+                log.info("{BLU}{0}{WHT} unchanged", dest)
+                return False
+    except FileNotFoundError:
+        pass
+    with open(f"{dest}.tmp", 'w') as f:
         f.write(text)
+    os.replace(f"{dest}.tmp", dest)
+    return True
+
+# Variables defined in sylex.conf, which is a makefile:
+# only plain `VAR = value` definitions (and :=, ?=, override) are understood
+def read_conf(path="sylex.conf"):
+    conf = {}
+    with open(path, 'r') as f:
+        text = f.read().replace("\\\n", " ")
+    for line in text.split("\n"):
+        line = line.split("#", 1)[0].strip()
+        if line.startswith("override "):
+            line = line[len("override "):]
+        for op in [":=", "?=", "="]:
+            if op in line:
+                (var, value) = line.split(op, 1)
+                var = var.strip()
+                if is_filename(var):
+                    conf[var] = value.strip()
+                break
+    return conf
 
 @log.path('Delete {BLU}{0}{WHT}')
 def rm_r(path):
@@ -81,31 +150,119 @@ def copy_file(src, dest, file=None):
         dest = f"{dest}/{file}"
     copy_file(src, dest)
 
+# Run `fn(**kwargs)` for every `kwargs` in `jobs`, over `n` processes.
+# The output of each job (diagnostics included) is replayed in the order
+# of `jobs` rather than as they complete, and the worst fatality
+# of all jobs is merged into `Err.fatality`.
+def parallel(fn, jobs, n=1):
+    if n <= 1:
+        return [fn(**kwargs) for kwargs in jobs]
+    from concurrent.futures import ProcessPoolExecutor
+    results = []
+    with ProcessPoolExecutor(n) as pool:
+        futures = [pool.submit(captured, fn, kwargs) for kwargs in jobs]
+        for future in futures:
+            (res, out, fatality) = future.result()
+            sys.stdout.write(out)
+            Err.fatality = max(Err.fatality, fatality)
+            results.append(res)
+    return results
+
+def captured(fn, kwargs):
+    # Workers are reused across jobs: start each one from a clean slate
+    Err.fatality = Err.ALWAYS
+    with io.StringIO() as buf:
+        with contextlib.redirect_stdout(buf):
+            res = fn(**kwargs)
+        return (res, buf.getvalue(), Err.fatality)
+
+# Contents of the directories looked up so far: checking that a file exists
+# costs one `os.scandir` per directory rather than one `stat` per file.
+class DirIndex:
+    listings = {}
+    stamps = {}
+
+    def files(d):
+        if d not in DirIndex.listings:
+            try:
+                DirIndex.stamps[d] = os.stat(d or ".").st_mtime_ns
+                with os.scandir(d or ".") as entries:
+                    DirIndex.listings[d] = set(e.name for e in entries if e.is_file())
+            except (FileNotFoundError, NotADirectoryError):
+                DirIndex.stamps[d] = None
+                DirIndex.listings[d] = set()
+        return DirIndex.listings[d]
+
+    # Forget the directories that had files added or removed since they
+    # were listed, for processes that outlive a single command
+    def refresh():
+        for d in list(DirIndex.listings):
+            try:
+                stamp = os.stat(d or ".").st_mtime_ns
+            except (FileNotFoundError, NotADirectoryError):
+                stamp = None
+            if stamp != DirIndex.stamps.get(d):
+                del DirIndex.listings[d]
+
+    def isfile(path):
+        (d, _, name) = path.rpartition("/")
+        return name in DirIndex.files(d)
+
+    def clear():
+        DirIndex.listings = {}
+        DirIndex.stamps = {}
+
+# Immutable path to a file, split into directory, name and extension.
+# Files are interned: all files with the same components are the same
+# object, and the strings computed from them are cached.
 class File:
-    def __init__(self, path):
+    __slots__ = ('dir', 'name', 'ext', 'cached_path', 'cached_name_of_path')
+    interned = {}
+
+    def __new__(cls, path):
         spath = path.rsplit("/", 1)
         dir = spath[0] if len(spath) > 1 else ""
         name = spath[-1]
         sname = name.rsplit(".", 1)
         name = sname[0]
         ext = sname[1] if len(sname) > 1 else None
-        self.dir = dir
-        self.name = name
-        self.ext = ext
+        return File.of(dir, name, ext)
 
-    def with_prefix(self, pre):
-        f = File("")
-        f.dir = pre + ("/" if self.dir != "" else "") + self.dir
-        f.name = self.name
-        f.ext = self.ext
+    def of(dir, name, ext):
+        key = (dir, name, ext)
+        f = File.interned.get(key)
+        if f is None:
+            f = object.__new__(File)
+            object.__setattr__(f, 'dir', dir)
+            object.__setattr__(f, 'name', name)
+            object.__setattr__(f, 'ext', ext)
+            object.__setattr__(f, 'cached_path', None)
+            object.__setattr__(f, 'cached_name_of_path', None)
+            File.interned[key] = f
         return f
 
+    def __setattr__(self, attr, value):
+        raise AttributeError(f"cannot set '{attr}', File is immutable")
+
+    def __reduce__(self):
+        return (File.of, (self.dir, self.name, self.ext))
+
+    # Interning makes equal files identical, but files are compared by
+    # value anyway so that this does not have to hold
+    def __eq__(self, other):
+        return self is other or (
+            isinstance(other, File)
+            and (self.dir, self.name, self.ext) == (other.dir, other.name, other.ext)
+        )
+
+    def __hash__(self):
+        return hash((self.dir, self.name, self.ext))
+
+    def with_prefix(self, pre):
+        return File.of(pre + ("/" if self.dir != "" else "") + self.dir, self.name, self.ext)
+
     def with_ext(self, ext):
-        f = File("")
-        f.dir = self.dir
-        f.name = self.name
-        f.ext = ext
-        return f
+        return File.of(self.dir, self.name, ext)
 
     def try_ext(self, ext):
         if self.ext is None:
@@ -129,13 +286,18 @@ class File:
         return os.path.isfile(self.path())
 
     def path(self):
-        p = self.dir + ("/" if self.dir != '' else '') + self.name
-        if self.ext != None:
-            p += "." + self.ext
-        return p.replace("./", "")
+        if self.cached_path is None:
+            p = self.dir + ("/" if self.dir != '' else '') + self.name
+            if self.ext != None:
+                p += "." + self.ext
+            object.__setattr__(self, 'cached_path', p.replace("./", ""))
+        return self.cached_path
 
     def name_of_path(self):
-        return self.path().replace("/", "__").replace("__", "/", 1)
+        if self.cached_name_of_path is None:
+            n = self.path().replace("/", "__").replace("__", "/", 1)
+            object.__setattr__(self, 'cached_name_of_path', n)
+        return self.cached_name_of_path
 
     def __str__(self):
         return "File({})".format(self.path())
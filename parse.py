@@ -4,8 +4,11 @@
 import re
 import sys
 import os
+import pickle
+import hashlib
 
 from error import Err
+from graph import Graph
 import lib
 import log
 
@@ -53,19 +56,6 @@ class Refs:
         return self.__str__()
 
 
-    def into_graph(refs):
-        graph = {}
-        for file in refs:
-            rs = refs[file]
-            if len(rs.induce) > 0:
-                graph[file] = rs.induce
-            for d in rs.depend:
-                if d not in graph:
-                    graph[d] = []
-                graph[d].append(file)
-        return graph
-
-
 class Cfg:
     def __init__(self):
         self.txt = []
@@ -184,7 +174,7 @@ class Cfg:
                 return None
             else:
                 file = lib.File("".join(self.path_stk) + file).try_ext("tex")
-                if not file.with_prefix("src").exists():
+                if not lib.DirIndex.isfile(file.with_prefix("src").path()):
                     Err.report(
                         kind="Nonexistent File",
                         msg="file {} was not found".format(file.path()),
@@ -265,27 +255,41 @@ class Cfg:
                         msg=f"'{f}' is a header, yet it has dependencies",
                         fatal=False,
                     )
-            graph = Refs.into_graph(self.refs)
+            graph = Graph.of_refs(self.refs)
+            copy = [(
+                sources.with_prefix("src").path(),
+                sources.with_prefix(f"{lib.build_dir}").name_of_path(),
+            ) for sources in self.txt + self.fig + self.bib + self.hdr]
+            extra = [
+                (
+                    pre.with_prefix(f"{lib.build_dir}").name_of_path(),
+                    " ".join(p.with_prefix(f"{lib.build_dir}").name_of_path() for p in post),
+                ) for (pre, post) in graph.edges()
+            ]
             lib.j2_render(
                 "deps.tex.mk",
                 proj.dest_deps,
                 tabs=False,
                 params={
                     'name': proj.name,
-                    'copy': [(
-                        sources.with_prefix("src").path(),
-                        sources.with_prefix(f"{lib.build_dir}").name_of_path(),
-                    ) for sources in self.txt + self.fig + self.bib + self.hdr],
-                    'extra': [
-                        (
-                            pre.with_prefix(f"{lib.build_dir}").name_of_path(),
-                            " ".join(
-                                p.with_prefix(f"{lib.build_dir}").name_of_path() for ps in graph[pre] for p in graph[ps]
-                            )
-                        ) for pre in graph if type(pre) == lib.File
-                    ],
+                    'copy': copy,
+                    'extra': extra,
+                    'manifest': proj.dest_manifest,
+                    'stamp': proj.dest_stamp,
                 },
             )
+            # Manifest for `sylex expand --batch`:
+            # one `src dest [post...]` line per file, where `dest` must
+            # also be refreshed whenever one of the `post` is.
+            # Prerequisites come first (components are numbered sinks first),
+            # so that a batch writes the headers before the files that depend
+            # on them and make finds every `dest` newer than its `post`.
+            posts = dict(extra)
+            order = [graph.comp[graph.file_index[f]] for f in self.txt + self.fig + self.bib + self.hdr]
+            lib.write_if_changed(proj.dest_manifest, "".join(
+                " ".join([src, dest] + posts.get(dest, "").split()) + "\n"
+                for (_, (src, dest)) in sorted(zip(order, copy), key=lambda e: e[0])
+            ))
             #with open(proj.dest_deps + ".bak", 'w') as f:
             #    for sources in self.txt + self.fig + self.bib + self.hdr:
             #        f.write("{}: {}\n\tcp $< $@\n".format(
@@ -303,21 +307,166 @@ class Cfg:
             #    f.write("\n")
 
 
+        # Entry point included by the Makefile. It is written every time,
+        # unlike the files above, so that make knows the configuration
+        # has been processed even if none of them changed.
+        @log.call
+        @log.path()
+        def print_spec():
+            with open(proj.dest_spec, 'w') as f:
+                f.write(f"{lib.autogen_header}\ninclude {proj.dest_build}\n")
+
+
+# Parsed configurations are kept in `build/cfg_<name>.cache`, keyed on the
+# contents of the .slx. Only configurations that parsed without any
+# diagnostic are cached, and since the only diagnostic that depends on
+# anything but the .slx is "Nonexistent File", a cached configuration
+# stays valid as long as no file was added to or removed from the
+# directories it refers to, i.e. as long as their timestamps are the same.
+#
+# Configurations are also kept in memory, by absolute path of their cache,
+# for processes that outlive a single command (see `daemon`).
+class CfgCache:
+    loaded = {}
+
+    def __init__(self, proj, text):
+        self.path = f"{lib.build_dir}/cfg_{proj.name}.cache"
+        self.key = hashlib.sha256(
+            "\0".join([text, proj.name, lib.date_modified]).encode()
+        ).hexdigest()
+
+    def dirs(cfg):
+        dirs = {}
+        for f in cfg.txt + cfg.fig + cfg.bib + cfg.hdr:
+            d = os.path.dirname(f.with_prefix("src").path()) or "."
+            if d not in dirs:
+                dirs[d] = os.stat(d).st_mtime_ns
+        return dirs
+
+    def load(self):
+        entry = CfgCache.loaded.get(os.path.abspath(self.path))
+        try:
+            if entry is None or entry[0] != self.key:
+                with open(self.path, 'rb') as f:
+                    entry = pickle.load(f)
+            (key, dirs, cfg) = entry
+        except Exception:
+            # missing, or written by a different version of sylex
+            return None
+        if key != self.key:
+            return None
+        for d in dirs:
+            try:
+                if os.stat(d).st_mtime_ns != dirs[d]:
+                    return None
+            except FileNotFoundError:
+                return None
+        CfgCache.loaded[os.path.abspath(self.path)] = entry
+        return cfg
+
+    def store(self, cfg):
+        os.makedirs(lib.build_dir, exist_ok=True)
+        entry = (self.key, CfgCache.dirs(cfg), cfg)
+        with open(f"{self.path}.tmp", 'wb') as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f"{self.path}.tmp", self.path)
+        CfgCache.loaded[os.path.abspath(self.path)] = entry
+
+
 # Read file f (in the texmk format) and return a workable descriptor
 @log.path('Read configuration for {RED}{0.name}{WHT}\nfrom {BLU}{0.src}{WHT}')
 def parse_cfg(proj, fail):
     with open(proj.src, 'r') as f:
-        Err.in_file(proj.src)
-        cfg = Cfg()
-        for line in f.readlines():
-            cfg.push(line.rstrip())
-            if Err.fatality >= Err.WARNING:
-                return None
-        if fail <= Err.fatality:
+        text = f.read()
+    Err.in_file(proj.src)
+    cache = CfgCache(proj, text)
+    cfg = cache.load()
+    if cfg is not None:
+        log.info("unchanged since last time")
+        return None if fail <= Err.fatality else cfg
+    cfg = Cfg()
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    for line in lines:
+        cfg.push(line.rstrip())
+        if Err.fatality >= Err.WARNING:
             return None
-        else:
-            root = lib.File(proj.name).with_ext("tex")
-            cfg.txt.append(root)
-            cfg.refs[root] = Refs()
-            return cfg
+    if fail <= Err.fatality:
+        return None
+    else:
+        root = lib.File(proj.name).with_ext("tex")
+        cfg.txt.append(root)
+        cfg.refs[root] = Refs()
+        cache.store(cfg)
+        return cfg
+
+
+
+# Parse one configuration from a clean error state, so that the diagnostics
+# of one project do not make the next one fail. Returns (cfg, fatality).
+def parse_job(proj, fail):
+    Err.fatality = Err.ALWAYS
+    cfg = parse_cfg(proj, fail)
+    return (cfg, Err.fatality)
+
+# Parse several configurations over `jobs` processes
+def parse_all(projs, fail, jobs=1):
+    fatality = Err.fatality
+    res = lib.parallel(parse_job, [{
+        'proj': proj,
+        'fail': fail,
+    } for proj in projs], jobs)
+    Err.fatality = max([fatality] + [f for (_, f) in res])
+    return res
+
+
+# Reverse index from the files that documents are built from to the make
+# targets that have to be rebuilt when they change: `<doc>.pdf` for
+# documents, `build/<fig>.pdf` for standalone figures.
+# A header also affects the figures that depend on it, directly or not,
+# through `>label`.
+class Affected:
+    def __init__(self, projs, cfgs):
+        self.docs = {}
+        self.figs = {}
+        into_pdf_build = lambda f: f.with_prefix(f"{lib.build_dir}").try_pdf().name_of_path()
+        for (proj, (cfg, _)) in zip(projs, cfgs):
+            self.add("sylex.conf", proj.name)
+            self.add(proj.src, proj.name)
+            if cfg is None:
+                continue
+            graph = Graph.of_refs(cfg.refs)
+            graph.reduce()
+            for file in graph.files:
+                self.add(file.with_prefix("src").path(), proj.name)
+            # a figure is affected by its source and its transitive prerequisites
+            for fig in cfg.fig:
+                g = graph.file_index[fig]
+                for f in [g] + graph.closure(g):
+                    src = graph.files[f].with_prefix("src").path()
+                    self.figs.setdefault(src, set()).add(into_pdf_build(fig))
+
+    def add(self, path, doc):
+        self.docs.setdefault(path, set()).add(doc)
+
+    # Parse the configurations of `projs` (quietly) and index them
+    def of(projs, jobs=1):
+        import contextlib
+        verbose = log.Trace.verbose
+        log.Trace.verbose = 'n'
+        try:
+            with contextlib.redirect_stdout(sys.stderr):
+                return Affected(projs, parse_all(projs, Err.ERROR, jobs))
+        finally:
+            log.Trace.verbose = verbose
 
+    # (documents, figures) affected by a change to any of `paths`
+    def targets(self, paths):
+        docs = set()
+        figs = set()
+        for p in paths:
+            p = os.path.relpath(p)
+            docs |= self.docs.get(p, set())
+            figs |= self.figs.get(p, set())
+        return (sorted(docs), sorted(figs))
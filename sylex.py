@@ -5,15 +5,54 @@
 
 import sys
 import os
-import jinja2 as j2
-import shutil
+
+
+# Hand the command over to `sylex daemon` if it is running.
+# This is done before anything else is imported, as for a forwarded command
+# the start of this process is all the time that is spent here: the client
+# only needs `json` and `socket`. The socket path and the commands are those
+# of `daemon.socket_path` and `daemon.commands`.
+# Returns the exit status, or None if the command has to be run locally.
+def forward(argv, path="build/sylex.sock"):
+    import json
+    import socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.connect(path)
+            conn.sendall(json.dumps({
+                'cwd': os.getcwd(),
+                'argv': argv,
+                'slx_dir': os.path.abspath(os.path.dirname(__file__)),
+            }).encode())
+            conn.shutdown(socket.SHUT_WR)
+            chunks = []
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                chunks.append(data)
+            reply = json.loads(b"".join(chunks).decode())
+    except (OSError, ValueError):
+        return None
+    if reply.get('status') is None:
+        return None
+    sys.stdout.write(reply['out'])
+    return reply['status']
+
+if __name__ == "__main__" and sys.argv[1:2] in (["expand"], ["build-conf"]):
+    if os.path.exists("build/sylex.sock"):
+        status = forward(sys.argv[1:])
+        if status is not None:
+            sys.exit(status)
+
+
 from argparse import ArgumentParser
 
 from error import Err
 import lib
 import log
-import expand
-import parse
+# `expand` and `parse` are imported by the subcommands that use them,
+# see `lib` for why
 
 
 @log.path('Create directory {BLU}{0}{WHT}')
@@ -104,13 +143,22 @@ class ProjFile:
     def __init__(self, s):
         self.name = s
         self.src = f"cfg_{s}.slx"
+        self.dest_spec = f"{lib.build_dir}/spec_{s}.tex.mk"
         self.dest_build = f"{lib.build_dir}/pdf_{s}.tex.mk"
         self.dest_param = f"{lib.build_dir}/param_{s}.tex.mk"
         self.dest_deps = f"{lib.build_dir}/deps_{s}.tex.mk"
+        self.dest_manifest = f"{lib.build_dir}/expand_{s}.lst"
+        self.dest_stamp = f"{lib.build_dir}/expand_{s}.stamp"
         if not os.path.exists(self.src):
             return TypeError(f"Configuration file '{self.src}' does not exist")
 
 
+# All projects of the current directory, whether or not they are in DOC
+def all_projs():
+    import glob
+    return [ProjFile(f[len("cfg_"):-len(".slx")]) for f in sorted(glob.glob("cfg_*.slx"))]
+
+
 def warnlevel(s):
     value = s.upper()
     match value:
@@ -133,10 +181,15 @@ class Args:
 sylex <command> [<args>]
 
 with commands:
+  affected       list the targets to rebuild after some files changed
+  build          compile documents without going through make
   build-aux      write auxiliary files from templates
   build-conf     instanciate makefiles for specific project
+  daemon         keep caches warm and serve expand/build-conf
+  compile        run pdflatex (and bibtex) until references are stable
   init           sync source code and templates
   expand         resolve relative filenames and conditional inclusions
+  watch          rebuild the documents affected by each change
   help           print help message
 """
         )
@@ -144,16 +197,56 @@ with commands:
         res = parser.parse_args(args[:1])
         args = args[1:]
         match res.command:
+            case 'affected': self.affected(args)
+            case 'build': self.build(args)
             case 'build-aux': self.build_aux(args)
             case 'build-conf': self.build_conf(args)
+            case 'compile': self.compile(args)
+            case 'daemon': self.daemon(args)
             case 'init': self.init(args)
             case 'expand': self.expand(args)
+            case 'watch': self.watch(args)
             case 'help': self.help(args)
             case other:
                 print(f"Unknown command: '{other}' is not an available subcommand")
                 sys.exit(1)
 
 
+    def affected(self, args):
+        import parse
+        parser = ArgumentParser(description='list the targets to rebuild after some files changed')
+        parser.add_argument('paths', nargs='+', help='files that changed')
+        parser.add_argument('--docs', action='store_true',
+                help='print the names of the affected documents instead of make targets')
+        parser.add_argument('--jobs', type=int, default=1, help='number of configurations parsed in parallel')
+        res = parser.parse_args(args)
+        (docs, figs) = parse.Affected.of(all_projs(), res.jobs).targets(res.paths)
+        if res.docs:
+            for d in docs:
+                print(d)
+        else:
+            for t in [f"{d}.pdf" for d in docs] + figs:
+                print(t)
+
+
+    def build(self, args):
+        import build
+        conf = lib.read_conf()
+        parser = ArgumentParser(description='compile documents without going through make')
+        parser.add_argument('--proj', type=ProjFile, nargs='*', help='which documents to build (default: DOC)')
+        parser.add_argument('--jobs', type=int, default=int(conf.get('JOBS') or 1),
+                help='number of steps run in parallel')
+        parser.add_argument('--level', type=warnlevel, default=Err.WARNING, help='error failure threshold')
+        parser.add_argument('--quick', action='store_true', help='compile each document only once')
+        parser.add_argument('--passes', type=int, default=5, help='maximum number of pdflatex passes')
+        res = parser.parse_args(args)
+        projs = res.proj
+        if projs is None:
+            projs = [ProjFile(s) for s in conf.get('DOC', '').split()]
+        if not build.build(projs, level=res.level, jobs=res.jobs, quick=res.quick, passes=res.passes):
+            sys.exit(2)
+
+
     def build_aux(self, args):
         parser = ArgumentParser(description='write auxiliairy files from templates')
         parser.add_argument('--common', action='store_true', help='generic TeX-related targets')
@@ -166,20 +259,57 @@ with commands:
 
 
     def build_conf(self, args):
-        parser = ArgumentParser(description='instanciate makefiles for specific project')
-        parser.add_argument('--proj', type=ProjFile, help='which project to build')
+        parser = ArgumentParser(description='instanciate makefiles for specific projects')
+        parser.add_argument('--proj', type=ProjFile, nargs='*', default=[], help='which projects to build')
+        parser.add_argument('--all', action='store_true', help='build all projects listed in DOC')
+        parser.add_argument('--jobs', type=int, default=1, help='number of configurations parsed in parallel')
         parser.add_argument('--level', type=warnlevel, help='error failure threshold')
         res = parser.parse_args(args)
-        cfg = parse.parse_cfg(res.proj, res.level)
+        import parse
+        projs = res.proj
+        if res.all:
+            projs = projs + [ProjFile(s) for s in lib.read_conf().get('DOC', '').split()]
+        cfgs = parse.parse_all(projs, res.level, res.jobs)
         mkdir(f"{lib.build_dir}")
-        if cfg is not None:
-            cfg.print(res.proj)
-        elif res.level <= Err.fatality:
+        failed = False
+        for (proj, (cfg, fatality)) in zip(projs, cfgs):
+            if cfg is not None:
+                Err.in_file(proj.src)
+                cfg.print(proj)
+            elif res.level <= fatality:
+                failed = True
+        if failed:
             if res.level == Err.NEVER:
                 sys.exit(0)
             sys.exit(2)
 
 
+    def compile(self, args):
+        import build
+        parser = ArgumentParser(description='run pdflatex (and bibtex) until references are stable')
+        parser.add_argument('name', help='document to compile, in the build directory')
+        parser.add_argument('--passes', type=int, default=5, help='maximum number of pdflatex passes')
+        res = parser.parse_args(args)
+        (ok, out) = build.converge(res.name, passes=res.passes)()
+        print(out, end="")
+        if not ok:
+            sys.exit(2)
+
+
+    def daemon(self, args):
+        import daemon
+        parser = ArgumentParser(description='keep caches warm and serve expand/build-conf')
+        parser.add_argument('--socket', default=daemon.socket_path, help='where to listen')
+        parser.add_argument('--stop', action='store_true', help='stop the running daemon')
+        res = parser.parse_args(args)
+        if res.stop:
+            if not daemon.stop(res.socket):
+                print("No daemon is running")
+                sys.exit(1)
+        else:
+            daemon.serve(res.socket, Args)
+
+
     def init(self, args):
         parser = ArgumentParser(description='synchronize source code and templates')
         res = parser.parse_args(args)
@@ -187,16 +317,55 @@ with commands:
 
 
     def expand(self, args):
+        import expand
         parser = ArgumentParser(description='replace relative filenames')
         parser.add_argument('--i', help='input file')
         parser.add_argument('--o', help='output file (if different from input)', required=False)
+        parser.add_argument('--variant', nargs='+', action='append', metavar=('OUT', 'FEATURE'),
+                help='output file followed by its features (may be repeated)', required=False)
+        parser.add_argument('--batch', help='expand all files listed in this manifest', required=False)
+        parser.add_argument('--changed', nargs='*', help='(with --batch) sources that were modified',
+                required=False)
+        parser.add_argument('--only', nargs='*', help='(with --batch) outputs to expand',
+                required=False)
         parser.add_argument('--features', nargs='*', help='features to include', required=False,
                 default=set())
+        parser.add_argument('--engine', choices=['read', 'stream', 'mmap'], default='read',
+                help='read the whole file at once, stream it line by line, '
+                    'or map it in memory and decode only the lines with markers')
+        parser.add_argument('--jobs', type=int, default=1,
+                help='(with --batch) number of files expanded in parallel')
+        parser.add_argument('--no-cache', action='store_true',
+                help='expand even if the output is known to be up to date')
         res = parser.parse_args(args)
-        if res.i.endswith("tex"):
-            expand.expand(i=res.i, o=res.o or res.i, features=expand.Features(res.features))
+        features = expand.Features(res.features)
+        if res.batch is not None:
+            expand.batch(res.batch, features=features, changed=res.changed, only=res.only,
+                    engine=res.engine, jobs=res.jobs, cache=not res.no_cache)
+            if Err.fatality >= Err.ERROR:
+                sys.exit(2)
+        elif res.variant is not None:
+            expand.expand_variants(i=res.i, variants=[
+                (o, expand.Features(fs)) for (o, *fs) in res.variant
+            ], cache=not res.no_cache)
         else:
-            lib.copy_file(res.i, res.o)
+            expand.expand_file(i=res.i, o=res.o or res.i, features=features,
+                    engine=res.engine, cache=not res.no_cache)
+
+    def watch(self, args):
+        import parse
+        import watch
+        parser = ArgumentParser(description='rebuild the documents affected by each change')
+        parser.add_argument('--target', nargs='*', help='make targets to rebuild on any change '
+                '(default: the pdfs of the affected documents)')
+        parser.add_argument('--debounce', type=float, default=0.2,
+                help='seconds without changes before rebuilding')
+        res = parser.parse_args(args)
+        watch.watch(
+            targets=res.target or None,
+            debounce=res.debounce,
+            index=lambda: parse.Affected.of(all_projs()),
+        )
 
     def help(self, args):
         pass
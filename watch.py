@@ -0,0 +1,179 @@
+# SyLeX
+#   Build descriptor for LaTeX
+
+import os
+import re
+import sys
+import select
+import struct
+import subprocess
+
+import lib
+import log
+
+# Recompilation after each write to disk.
+#
+# The sources, the configurations and sylex.conf are watched through
+# inotify, which wakes us up only when something changed. A burst of
+# writes (an editor saving several files, a `git checkout`) is merged
+# into a single rebuild of the documents it affects, as found by
+# `parse.Affected`.
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_ISDIR = 0x40000000
+IN_IGNORED = 0x8000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+event_header = struct.Struct("iIII")
+
+re_cfg = re.compile(r"^cfg_(.*)\.slx$")
+
+
+# Minimal binding of inotify(7) through ctypes
+class Inotify:
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {}
+
+    def add(self, path):
+        import ctypes
+        wd = self.libc.inotify_add_watch(self.fd, path.encode(), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"cannot watch '{path}'")
+        self.paths[wd] = path
+        return wd
+
+    # Watch `root` and all directories below it, that may disappear
+    # while we walk them
+    def add_tree(self, root):
+        for (d, _, _) in os.walk(root):
+            try:
+                self.add(d)
+            except OSError:
+                pass
+
+    # Events that arrive within `timeout` seconds (None: wait for the first
+    # one), as a list of (path, mask)
+    def read(self, timeout=None):
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        k = 0
+        while k < len(data):
+            (wd, m, _, n) = event_header.unpack_from(data, k)
+            k += event_header.size
+            name = data[k:k + n].rstrip(b"\0").decode(errors='replace')
+            k += n
+            d = self.paths.get(wd)
+            if m & IN_IGNORED:
+                self.paths.pop(wd, None)
+                continue
+            if d is None:
+                continue
+            path = name if d == "." else (f"{d}/{name}" if name != "" else d)
+            events.append((path, m))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Whether a change to `path` can affect a document. The project root is
+# watched only for sylex.conf and the configurations (the build writes
+# the pdfs there), and temporary files of editors are left out.
+def relevant(path):
+    name = os.path.basename(path)
+    if name.startswith(".") or name.endswith("~") or name.endswith(".swp"):
+        return False
+    return path in ("sylex.conf", "src") or path.startswith("src/") or re_cfg.match(path) is not None
+
+# Show the first error of a failed build, as texwatch did
+def notify(out):
+    msg = out.split("!", 1)[-1].strip()
+    try:
+        subprocess.run(["notify-send", "LaTeX Error", msg, "-t", "5000"])
+    except FileNotFoundError:
+        pass
+
+def make(targets):
+    log.info("make {BLU}{0}{WHT}", " ".join(targets))
+    proc = subprocess.run(
+        ["make", *targets],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        errors='replace',
+    )
+    print(proc.stdout, end="")
+    if proc.returncode != 0 or "Fatal" in proc.stdout:
+        notify(proc.stdout)
+        return False
+    return True
+
+
+# Rebuild the documents affected by each change, or `targets` on any change.
+# `index()` returns a `parse.Affected` for all configurations: it is built
+# again whenever a configuration or sylex.conf changes.
+@log.path('Watch sources')
+def watch(*, index, targets=None, debounce=0.2):
+    try:
+        ino = Inotify()
+        ino.add(".")
+        if os.path.isdir("src"):
+            ino.add_tree("src")
+    except (OSError, AttributeError) as e:
+        print(f"Cannot watch files: {e}")
+        sys.exit(1)
+    docs = lib.read_conf().get('DOC', '').split()
+    affected = index()
+    make(targets or [f"{d}.pdf" for d in docs])
+    try:
+        while True:
+            events = ino.read()
+            while True:
+                more = ino.read(debounce)
+                if len(more) == 0:
+                    break
+                events += more
+            changed = []
+            for (path, m) in events:
+                if not relevant(path):
+                    continue
+                if m & IN_ISDIR and m & (IN_CREATE | IN_MOVED_TO):
+                    ino.add_tree(path)
+                if path not in changed:
+                    changed.append(path)
+            if any(p == "sylex.conf" or re_cfg.match(p) for p in changed):
+                docs = lib.read_conf().get('DOC', '').split()
+                affected = index()
+            if targets is not None:
+                todo = targets if len(changed) > 0 else []
+            else:
+                todo = [f"{d}.pdf" for d in affected.targets(changed)[0] if d in docs]
+            if len(todo) > 0:
+                log.info("changed: {BLU}{0}{WHT}", " ".join(changed))
+                make(todo)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ino.close()